@@ -0,0 +1,61 @@
+"""
+LaMaをOpenVINO IRに変換し、NNCFでINT8量子化するスクリプト
+CPUで起動したserver.pyは同じディレクトリの big-lama-int8.xml を自動で使う
+
+キャリブレーションにはデバッグ出力の元画像 (output/*_original.jpg) を使う
+usage: uv run --with openvino --with nncf python quantize_lama.py [画像ディレクトリ]
+"""
+import sys
+from pathlib import Path
+
+import cv2
+import nncf
+import numpy as np
+import openvino as ov
+import torch
+from PIL import Image
+from simple_lama_inpainting import SimpleLama
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+OUTPUT_PATH = SCRIPT_DIR / "big-lama-int8.xml"
+CALIBRATION_SIZE = (512, 512)  # 8の倍数
+MAX_CALIBRATION_SAMPLES = 100
+
+
+def load_calibration_samples(image_dir: Path) -> list[tuple[np.ndarray, np.ndarray]]:
+    """元画像にランダムな楕円マスクを付けて (image, mask) の入力を作る"""
+    rng = np.random.default_rng(0)
+    samples = []
+    for path in sorted(image_dir.glob("*_original.jpg"))[:MAX_CALIBRATION_SAMPLES]:
+        image = Image.open(path).convert("RGB").resize(CALIBRATION_SIZE, Image.Resampling.BILINEAR)
+        image_array = np.asarray(image, dtype=np.float32).transpose(2, 0, 1)[None] / 255
+
+        mask = np.zeros((CALIBRATION_SIZE[1], CALIBRATION_SIZE[0]), dtype=np.uint8)
+        for _ in range(rng.integers(1, 4)):
+            center = (int(rng.integers(0, CALIBRATION_SIZE[0])), int(rng.integers(0, CALIBRATION_SIZE[1])))
+            axes = (int(rng.integers(16, 128)), int(rng.integers(16, 128)))
+            cv2.ellipse(mask, center, axes, 0, 0, 360, 1, thickness=-1)
+
+        samples.append((image_array, mask[None, None].astype(np.float32)))
+    return samples
+
+
+def main():
+    image_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else SCRIPT_DIR / "output"
+    samples = load_calibration_samples(image_dir)
+    if not samples:
+        raise SystemExit(f"No calibration images (*_original.jpg) in {image_dir}. Run the server with debug=true first.")
+
+    print("Converting LaMa to OpenVINO IR...")
+    lama = SimpleLama(device=torch.device("cpu"))
+    example_input = tuple(torch.from_numpy(array) for array in samples[0])
+    ov_model = ov.convert_model(lama.model, example_input=example_input)
+
+    print(f"Quantizing LaMa to INT8 with {len(samples)} calibration samples...")
+    quantized = nncf.quantize(ov_model, nncf.Dataset(samples), subset_size=len(samples))
+    ov.save_model(quantized, OUTPUT_PATH)
+    print(f"Saved: {OUTPUT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,39 @@ FastSAM WebSocket Server for Quest3 VR
 Tailscale経由で接続可能
 HTTP POST /segment エンドポイントも提供
 """
-from fastapi import FastAPI
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 from ultralytics import FastSAM
 from simple_lama_inpainting import SimpleLama
 from typing import Literal
+from contextlib import asynccontextmanager
 from transformers import SegformerForSemanticSegmentation, SegformerImageProcessor
+from turbojpeg import TurboJPEG, TJPF_RGB
 import torch
+import torch.nn.functional as F
+import torchvision
 import cv2
-import base64
+import pybase64
+import struct
 import colorsys
 import numpy as np
+import orjson
 from PIL import Image
-from io import BytesIO
 import asyncio
+import time
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import threading
+
+try:
+    import openvino as ov
+except ImportError:
+    ov = None
 
 # 出力ディレクトリを作成
 OUTPUT_DIR = Path(__file__).resolve().parent / "output"
@@ -33,11 +49,41 @@ class SegmentRequest(BaseModel):
     iou: float = 0.9
     max_masks: int = 20
     min_area: float = 0.005  # Minimum area as fraction of image (0.5% default)
-    combined_inpaint: bool = True  # If True, inpaint all masks combined; if False, inpaint each mask individually
+    combined_inpaint: bool = True  # If True, return one combined inpainted image; if False, return per-mask inpainted crops
     dilate_pixels: int = 10  # Pixels to dilate mask before inpainting
     inpaint_scale: float = 0.25  # Scale factor for inpainting (0.25-1.0, lower = faster but lower quality)
     exclude_background: Literal["none", "segformer", "heuristic"] = "none"  # Background exclusion method
     background_overlap_threshold: float = 0.5  # Overlap ratio threshold for background exclusion
+    debug: bool = False  # If True, save debug images to the output directory
+    mask_format: Literal["png", "sprite", "rle", "packed"] = "png"  # "sprite": pack all masks into one PNG (mask_sprite) with per-mask sprite_y offsets, "rle": run lengths instead of PNG, "packed": all masks bit-packed into one buffer (mask_packed) with per-mask packed_offset
+    max_image_size: int | None = Field(None, gt=0)  # If set, downscale so the long side is at most this (FastSAM infers at 640 anyway); bbox/image_size are then in the downscaled coordinates
+
+
+class OpenVINOLama:
+    """
+    OpenVINOでINT8量子化したLaMa（CPU推論用、quantize_lama.pyで作成）
+    lama_model.modelと同じく(image, mask)テンソルを受け取り、補完済み画像テンソルを返す
+    """
+
+    def __init__(self, model_path: Path):
+        self.core = ov.Core()
+        self.model = self.core.read_model(model_path)
+        # 複数のリクエストがスレッドプールから同時に呼ぶので、同じ形状を二重にコンパイルしないようロックする
+        self.compile_lock = threading.Lock()
+
+    @lru_cache(maxsize=8)
+    def compile_for_shape(self, height: int, width: int):
+        """入力サイズごとに静的形状でコンパイル（形状が変わると再コンパイルになるためキャッシュ、compile_lockを取って呼ぶ）"""
+        model = self.model.clone()
+        model.reshape({0: [1, 3, height, width], 1: [1, 1, height, width]})
+        return self.core.compile_model(model, "CPU")
+
+    def __call__(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        with self.compile_lock:
+            compiled = self.compile_for_shape(*image.shape[2:])
+        # compiled(...)は共有の暗黙のInferRequestを使い回し、同時に呼ぶと入力が混ざるため呼び出しごとに作る
+        output = compiled.create_infer_request().infer([image.numpy(), mask.numpy()])[0]
+        return torch.from_numpy(output)
 
 
 def generate_distinct_color(index: int) -> list[int]:
@@ -47,7 +93,35 @@ def generate_distinct_color(index: int) -> list[int]:
     r, g, b = colorsys.hsv_to_rgb(hue, 0.7, 0.9)
     return [int(r * 255), int(g * 255), int(b * 255)]
 
-app = FastAPI(title="FastSAM WebSocket Server")
+
+# generate_distinct_colorの結果を起動時に計算しておく色LUT（マスク/クラスIDで引く）
+COLOR_LUT = np.array([generate_distinct_color(i) for i in range(256)], dtype=np.uint8)
+COLOR_TABLE = COLOR_LUT.tolist()  # レスポンスJSON用（list[int]のまま返す）
+
+
+def distinct_colors(count: int) -> np.ndarray:
+    """ID 0..count-1 の色を(count, 3)のuint8配列で取得（LUTを超える分だけ計算する）"""
+    if count <= len(COLOR_LUT):
+        return COLOR_LUT[:count]
+    extra = [generate_distinct_color(i) for i in range(len(COLOR_LUT), count)]
+    return np.concatenate([COLOR_LUT, np.array(extra, dtype=np.uint8)])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """FastSAMのバッチ推論ワーカーをサーバーの起動/終了に合わせて管理"""
+    global fastsam_queue, inference_semaphore
+    # 初回リクエストでcuDNN/oneDNNの初期化を払わないよう、受付開始前にダミー推論しておく
+    await asyncio.to_thread(warmup_models)
+    fastsam_queue = asyncio.Queue()
+    inference_semaphore = asyncio.Semaphore(MAX_CONCURRENT_INFERENCE)
+    start_fastsam_worker()
+    yield
+    fastsam_worker.cancel()
+    segformer_executor.shutdown(wait=False)
+
+
+# 大きなBase64文字列を含むレスポンスはorjsonでシリアライズする
+app = FastAPI(title="FastSAM WebSocket Server", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS設定（必要に応じて）
 app.add_middleware(
@@ -58,48 +132,145 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 推論デバイス (CUDAがあればGPU + FP16)
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+USE_HALF = DEVICE == "cuda"
+# CPUでは: リクエストの並列化はスレッドプール側で行うのでinter-opスレッドは1本に絞る
+# （intra-opはPyTorchのデフォルト=物理コア数のまま）。BF16対応CPU（AVX-512 BF16/AMX）ならFastSAMをBF16で推論
+USE_CPU_BF16 = False
+if DEVICE == "cuda":
+    # Quest3のフレームは毎回同じ解像度なので、形状ごとに最速のcuDNNアルゴリズムを一度だけ選ばせる
+    torch.backends.cudnn.benchmark = True
+elif DEVICE == "cpu":
+    torch.set_num_interop_threads(1)
+    USE_CPU_BF16 = torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+print(f"Inference device: {DEVICE} (half={USE_HALF}, cpu_bf16={USE_CPU_BF16}, threads={torch.get_num_threads()})")
+
+# FastSAMのマイクロバッチ設定
+FASTSAM_MAX_BATCH = 4  # 1回の推論にまとめる最大リクエスト数
+FASTSAM_BATCH_WINDOW = 0.005  # 最初のリクエストから追加を待つ時間（秒）
+
 # FastSAMモデルをロード
+# CUDA実行時はTensorRTエンジン（README参照、FastSAM-s.ptと同じ場所にエクスポート）があればそちらを使う
+# エンジンがなくtensorrtがインストールされていれば、初回起動時に一度だけエクスポートする
+FASTSAM_ENGINE_PATH = Path("FastSAM-s.engine")
 print("Loading FastSAM model...")
-model = FastSAM("FastSAM-s.pt")
+if DEVICE == "cuda" and not FASTSAM_ENGINE_PATH.exists() and importlib.util.find_spec("tensorrt") is not None:
+    print("Exporting FastSAM to TensorRT (first run only, this takes a few minutes)...")
+    try:
+        # 推論は常にimgsz=640なので固定サイズ・マイクロバッチの最大数に合わせた動的バッチでビルドする
+        exported_path = FastSAM("FastSAM-s.pt").export(
+            format="engine", imgsz=640, half=True, dynamic=True, batch=FASTSAM_MAX_BATCH, device=0
+        )
+        if Path(exported_path).resolve() != FASTSAM_ENGINE_PATH.resolve():
+            Path(exported_path).replace(FASTSAM_ENGINE_PATH)
+    except Exception as e:
+        print(f"TensorRT export failed, using FastSAM-s.pt: {e}")
+if DEVICE == "cuda" and FASTSAM_ENGINE_PATH.exists():
+    model = FastSAM(str(FASTSAM_ENGINE_PATH))
+    print(f"FastSAM TensorRT engine loaded: {FASTSAM_ENGINE_PATH}")
+else:
+    model = FastSAM("FastSAM-s.pt")
 print("FastSAM model loaded successfully!")
 
 # LaMaモデルをロード
+# FFCのFFTはFP16だと2のべき乗サイズしか扱えないため、LaMaはFP32のままGPUに載せる
 print("Loading LaMa model...")
-lama_model = SimpleLama()
+lama_model = SimpleLama(device=torch.device(DEVICE))
 print("LaMa model loaded successfully!")
 
-# SegFormerモデルをロード (ADE20K学習済み、壁/床/天井検出用)
-print("Loading SegFormer model...")
-segformer_processor = SegformerImageProcessor.from_pretrained("nvidia/segformer-b0-finetuned-ade-512-512")
-segformer_model = SegformerForSemanticSegmentation.from_pretrained("nvidia/segformer-b0-finetuned-ade-512-512")
-print("SegFormer model loaded successfully!")
+# CPU実行時はINT8量子化済みのOpenVINO版LaMaがあればそちらを使う
+LAMA_OPENVINO_PATH = Path(__file__).resolve().parent / "big-lama-int8.xml"
+lama_openvino = None
+if DEVICE == "cpu" and LAMA_OPENVINO_PATH.exists():
+    if ov is None:
+        print(f"Found {LAMA_OPENVINO_PATH.name} but openvino is not installed, using PyTorch LaMa")
+    else:
+        print("Loading OpenVINO INT8 LaMa model...")
+        lama_openvino = OpenVINOLama(LAMA_OPENVINO_PATH)
+        print("OpenVINO INT8 LaMa model loaded successfully!")
+
+# SegFormerモデル (ADE20K学習済み、壁/床/天井検出用)
+# exclude_background="segformer" のリクエストが来るまでロードしない
+SEGFORMER_MODEL_NAME = "nvidia/segformer-b0-finetuned-ade-512-512"
+
+# torch.compile(mode="reduce-overhead")のCUDAグラフはスレッドローカルに記録されるため、
+# SegFormerのロード・推論は常にこの1スレッドで実行する（デフォルトのスレッドプールだと別スレッドで再記録される）
+segformer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segformer")
+segformer_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def load_segformer() -> tuple[SegformerImageProcessor, torch.nn.Module]:
+    """SegFormerのプロセッサとモデルをロード（get_segformerから呼ぶ）"""
+    print("Loading SegFormer model...")
+    processor = SegformerImageProcessor.from_pretrained(SEGFORMER_MODEL_NAME)
+    segformer = SegformerForSemanticSegmentation.from_pretrained(SEGFORMER_MODEL_NAME).to(DEVICE).eval()
+    if USE_HALF:
+        segformer = segformer.half()
+    print("SegFormer model loaded successfully!")
+
+    # SegFormerをtorch.compileで最適化
+    # プロセッサが常に512x512へリサイズするため入力形状は固定で、グラフは再コンパイルされない
+    # LaMaはTorchScriptモデル(torch.jit)なのでdynamoでトレースできず、対象外
+    if DEVICE == "cuda":
+        print("Compiling SegFormer with torch.compile...")
+        segformer = torch.compile(segformer, mode="reduce-overhead")
+        # ダミー入力で一度推論してコンパイルコストをロード時に払っておく
+        warmup_inputs = processor(images=Image.new("RGB", (512, 512)), return_tensors="pt")
+        with torch.inference_mode():
+            segformer(pixel_values=warmup_inputs["pixel_values"].to(DEVICE, dtype=torch.float16))
+        print("SegFormer compiled successfully!")
+
+    return processor, segformer
+
+
+def get_segformer() -> tuple[SegformerImageProcessor, torch.nn.Module]:
+    """SegFormerを初回呼び出し時にロード（同時に来た初回リクエストで二重にロード/コンパイルしないようロックする）"""
+    with segformer_lock:
+        return load_segformer()
+
 
 # ADE20Kの背景クラスID (壁=0, 床=3, 天井=5)
 BACKGROUND_CLASS_IDS = [0, 3, 5]
+BACKGROUND_CLASS_IDS_TENSOR = torch.tensor(BACKGROUND_CLASS_IDS, dtype=torch.uint8, device=DEVICE)
 
+# 1バイト中の立っているビット数（ビットパックしたマスクの面積計算用）
+POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
-def create_mask_overlay(img_array: np.ndarray, masks: np.ndarray) -> np.ndarray:
-    """マスクを画像にオーバーレイして可視化"""
-    overlay = img_array.copy()
-    for i, mask in enumerate(masks):
-        # マスクを元画像サイズにリサイズ
-        mask_resized = cv2.resize(
-            (mask > 0.5).astype(np.uint8),
-            (img_array.shape[1], img_array.shape[0]),
-            interpolation=cv2.INTER_NEAREST
-        )
-        color = generate_distinct_color(i)
-        # マスク領域に色を重ねる
-        for c in range(3):
-            overlay[:, :, c] = np.where(
-                mask_resized > 0,
-                overlay[:, :, c] * 0.5 + color[c] * 0.5,
-                overlay[:, :, c]
-            )
-    return overlay
+# libjpeg-turboを直接使ってJPEGをエンコード/デコード（ライブラリが見つからなければOpenCV/PILにフォールバック）
+try:
+    turbo_jpeg = TurboJPEG()
+except (OSError, RuntimeError) as e:
+    print(f"TurboJPEG unavailable, falling back to OpenCV/PIL for JPEG encoding/decoding: {e}")
+    turbo_jpeg = None
 
 
-async def save_debug_images(
+def create_mask_overlay(img_array: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    """マスクを画像にオーバーレイして可視化（全マスクを一括でブレンド）"""
+    height, width = img_array.shape[:2]
+    # マスクを(H, W, N)に詰めて一度だけ元画像サイズにリサイズ
+    # 0/1のuint8マスク（run_segmentationのbin_masks）はそのまま並べ替えるだけにして、閾値処理の2パスを省く
+    if masks.dtype != np.uint8:
+        masks = (masks > 0.5).astype(np.uint8)
+    masks_bin = np.ascontiguousarray(masks.transpose(1, 2, 0))
+    if masks_bin.shape[:2] != (height, width):
+        masks_bin = cv2.resize(masks_bin, (width, height), interpolation=cv2.INTER_NEAREST)
+        masks_bin = masks_bin.reshape(height, width, -1)  # N=1だとチャンネル次元が落ちるため
+
+    # 後ろのマスクを上に描くラベルマップ（0 = マスクなし）
+    num_masks = masks_bin.shape[2]
+    label = num_masks - np.argmax(masks_bin[:, :, ::-1], axis=2)
+    label[~masks_bin.any(axis=2)] = 0
+
+    # 色LUTを引いて50%ブレンド（float中間配列を作らないようuint16で計算）
+    colors_lut = np.zeros((num_masks + 1, 3), dtype=np.uint16)
+    colors_lut[1:] = distinct_colors(num_masks)
+    blended = ((img_array.astype(np.uint16) + colors_lut[label]) >> 1).astype(np.uint8)
+    return np.where(label[:, :, None] > 0, blended, img_array)
+
+
+def write_debug_images(
     timestamp: str,
     original_image: Image.Image,
     raw_masks: np.ndarray | None,
@@ -108,77 +279,75 @@ async def save_debug_images(
     background_mask: np.ndarray | None = None,
     segformer_predicted: np.ndarray | None = None,
 ):
-    """非同期で画像をoutputディレクトリに保存"""
-    try:
-        # 元画像をnumpy配列に変換
-        img_array = np.array(original_image.convert("RGB"))
-
-        # 元画像を保存
-        original_path = OUTPUT_DIR / f"{timestamp}_original.jpg"
-        original_image.save(original_path, format="JPEG", quality=90)
-        print(f"[DEBUG] Saved: {original_path}")
-
-        # フィルタリング前のセグメンテーション結果を保存
-        if raw_masks is not None and len(raw_masks) > 0:
-            overlay_all = create_mask_overlay(img_array, raw_masks)
-            segmented_all_path = OUTPUT_DIR / f"{timestamp}_segmented_all.jpg"
-            Image.fromarray(overlay_all.astype(np.uint8)).save(segmented_all_path, format="JPEG", quality=90)
-            print(f"[DEBUG] Saved: {segmented_all_path} ({len(raw_masks)} masks)")
-
-        # フィルタリング後のセグメンテーション結果を保存
-        if filtered_masks is not None and len(filtered_masks) > 0:
-            overlay_filtered = create_mask_overlay(img_array, filtered_masks)
-            segmented_path = OUTPUT_DIR / f"{timestamp}_segmented.jpg"
-            Image.fromarray(overlay_filtered.astype(np.uint8)).save(segmented_path, format="JPEG", quality=90)
-            print(f"[DEBUG] Saved: {segmented_path} ({len(filtered_masks)} masks)")
-
-        # Inpaint結果を保存
-        if inpainted_image is not None:
-            inpainted_path = OUTPUT_DIR / f"{timestamp}_inpainted.jpg"
-            inpainted_image.save(inpainted_path, format="JPEG", quality=90)
-            print(f"[DEBUG] Saved: {inpainted_path}")
-
-        # 背景マスク（SegFormer）を保存
-        if background_mask is not None:
-            # 背景マスクを元画像サイズにリサイズ
+    """デバッグ画像（オーバーレイ含む）を作ってoutputディレクトリに保存（スレッドプールから呼ぶ）"""
+    # 元画像をnumpy配列に変換
+    img_array = np.array(original_image.convert("RGB"))
+
+    # 元画像を保存
+    original_path = OUTPUT_DIR / f"{timestamp}_original.jpg"
+    original_image.save(original_path, format="JPEG", quality=90)
+    print(f"[DEBUG] Saved: {original_path}")
+
+    # フィルタリング前のセグメンテーション結果を保存
+    if raw_masks is not None and len(raw_masks) > 0:
+        overlay_all = create_mask_overlay(img_array, raw_masks)
+        segmented_all_path = OUTPUT_DIR / f"{timestamp}_segmented_all.jpg"
+        Image.fromarray(overlay_all.astype(np.uint8)).save(segmented_all_path, format="JPEG", quality=90)
+        print(f"[DEBUG] Saved: {segmented_all_path} ({len(raw_masks)} masks)")
+
+    # フィルタリング後のセグメンテーション結果を保存
+    if filtered_masks is not None and len(filtered_masks) > 0:
+        overlay_filtered = create_mask_overlay(img_array, filtered_masks)
+        segmented_path = OUTPUT_DIR / f"{timestamp}_segmented.jpg"
+        Image.fromarray(overlay_filtered.astype(np.uint8)).save(segmented_path, format="JPEG", quality=90)
+        print(f"[DEBUG] Saved: {segmented_path} ({len(filtered_masks)} masks)")
+
+    # Inpaint結果を保存
+    if inpainted_image is not None:
+        inpainted_path = OUTPUT_DIR / f"{timestamp}_inpainted.jpg"
+        inpainted_image.save(inpainted_path, format="JPEG", quality=90)
+        print(f"[DEBUG] Saved: {inpainted_path}")
+
+    # 背景マスク（SegFormer）を保存
+    if background_mask is not None:
+        # 背景マスクを元画像サイズにリサイズ（フィルタ用に同サイズで作ってあれば不要）
+        bg_resized = background_mask
+        if bg_resized.shape != img_array.shape[:2]:
             bg_resized = cv2.resize(
                 background_mask,
                 (img_array.shape[1], img_array.shape[0]),
                 interpolation=cv2.INTER_NEAREST
             )
-            # 背景領域を赤でオーバーレイ
-            bg_overlay = img_array.copy()
-            bg_overlay[:, :, 0] = np.where(bg_resized > 0, 255, bg_overlay[:, :, 0])  # R
-            bg_overlay[:, :, 1] = np.where(bg_resized > 0, bg_overlay[:, :, 1] * 0.5, bg_overlay[:, :, 1])  # G
-            bg_overlay[:, :, 2] = np.where(bg_resized > 0, bg_overlay[:, :, 2] * 0.5, bg_overlay[:, :, 2])  # B
-            background_path = OUTPUT_DIR / f"{timestamp}_background.jpg"
-            Image.fromarray(bg_overlay.astype(np.uint8)).save(background_path, format="JPEG", quality=90)
-            print(f"[DEBUG] Saved: {background_path}")
-
-        # SegFormer全クラス予測結果を保存
-        if segformer_predicted is not None:
-            # 各クラスに固有の色を割り当てて可視化
-            pred_resized = cv2.resize(
-                segformer_predicted.astype(np.uint8),
-                (img_array.shape[1], img_array.shape[0]),
-                interpolation=cv2.INTER_NEAREST
-            )
-            # クラスごとに色を生成
-            segformer_overlay = img_array.copy()
-            unique_classes = np.unique(pred_resized)
-            for class_id in unique_classes:
-                color = generate_distinct_color(class_id)
-                mask = pred_resized == class_id
-                for c in range(3):
-                    segformer_overlay[:, :, c] = np.where(
-                        mask,
-                        segformer_overlay[:, :, c] * 0.4 + color[c] * 0.6,
-                        segformer_overlay[:, :, c]
-                    )
-            segformer_path = OUTPUT_DIR / f"{timestamp}_segformer.jpg"
-            Image.fromarray(segformer_overlay.astype(np.uint8)).save(segformer_path, format="JPEG", quality=90)
-            print(f"[DEBUG] Saved: {segformer_path} ({len(unique_classes)} classes)")
+        # 背景領域を赤でオーバーレイ
+        # R = 255, G/B = 半分（uint8のままシフトで計算）
+        bg_overlay = img_array.copy()
+        bg_pixels = bg_resized > 0
+        bg_overlay[bg_pixels] = (bg_overlay[bg_pixels] >> 1) | np.array([255, 0, 0], dtype=np.uint8)
+        background_path = OUTPUT_DIR / f"{timestamp}_background.jpg"
+        Image.fromarray(bg_overlay).save(background_path, format="JPEG", quality=90)
+        print(f"[DEBUG] Saved: {background_path}")
+
+    # SegFormer全クラス予測結果を保存
+    if segformer_predicted is not None:
+        # 各クラスに固有の色を割り当てて可視化
+        pred_resized = cv2.resize(
+            segformer_predicted.astype(np.uint8),
+            (img_array.shape[1], img_array.shape[0]),
+            interpolation=cv2.INTER_NEAREST
+        )
+        # クラスIDで色LUTを引いて一括で40:60ブレンド（floatに昇格させずuint16で計算）
+        unique_classes = np.unique(pred_resized)
+        colors_lut = distinct_colors(int(unique_classes[-1]) + 1).astype(np.uint16)
+        segformer_overlay = ((img_array.astype(np.uint16) * 2 + colors_lut[pred_resized] * 3) // 5).astype(np.uint8)
+        segformer_path = OUTPUT_DIR / f"{timestamp}_segformer.jpg"
+        Image.fromarray(segformer_overlay).save(segformer_path, format="JPEG", quality=90)
+        print(f"[DEBUG] Saved: {segformer_path} ({len(unique_classes)} classes)")
+
 
+async def save_debug_images(**kwargs):
+    """デバッグ画像をバックグラウンドで保存（オーバーレイの合成も含めてスレッドで実行し、イベントループを塞がない）"""
+    try:
+        await asyncio.to_thread(write_debug_images, **kwargs)
     except Exception as e:
         print(f"[DEBUG] Failed to save debug images: {e}")
 
@@ -197,20 +366,272 @@ def expand_bbox(bbox: list[float], image_size: tuple[int, int], padding_ratio: f
     ]
 
 
-def get_background_mask_segformer(image: Image.Image) -> np.ndarray:
-    """SegFormerで壁/床/天井のマスクを取得"""
+def decode_image(image_data: bytes, max_size: int | None = None) -> tuple[np.ndarray, tuple[int, int]]:
+    """
+    画像バイト列を(H, W, 3)のRGB配列にデコード（JPEGはlibjpeg-turboで直接、それ以外はOpenCV）
+
+    Args:
+        image_data: JPEG/PNGのバイト列
+        max_size: 長辺の最大ピクセル数（Noneなら縮小しない）
+
+    Returns:
+        image: RGB配列（max_sizeを超える場合は長辺がmax_sizeになるよう縮小）
+        original_size: 縮小前の(width, height)
+    """
+    if turbo_jpeg is not None and image_data[:2] == b"\xff\xd8":
+        width, height, _, _ = turbo_jpeg.decode_header(image_data)
+        scaling_factor = None
+        if max_size is not None and max(width, height) > max_size:
+            # libjpeg-turboはDCT領域で1/2, 1/4...に縮小しながらデコードできる（捨てる画素をデコードしない）
+            # max_size以上を保てる最小の倍率を選び、残りはINTER_AREAで縮小する
+            scaling_factor = min(
+                (factor for factor in turbo_jpeg.scaling_factors if max(width, height) * factor[0] >= max_size * factor[1]),
+                key=lambda factor: factor[0] / factor[1],
+            )
+        image = turbo_jpeg.decode(image_data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+    else:
+        # np.frombufferはコピーせずにバイト列を参照する（BytesIO/PILを経由しない）
+        bgr = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise ValueError("Failed to decode image")
+        height, width = bgr.shape[:2]
+        image = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    if max_size is not None and max(image.shape[:2]) > max_size:
+        scale = max_size / max(image.shape[:2])
+        new_size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+    return image, (width, height)
+
+
+def decode_image_for_fastsam(image_data: bytes, max_size: int | None = None) -> tuple[np.ndarray, np.ndarray, tuple[int, int]]:
+    """
+    decode_imageに加えてFastSAM用のBGR配列も作る（全画素のコピーなので、デコードと同じスレッドで行う）
+    ultralyticsはPIL画像だとRGB変換のコピー + BGR反転のコピーをするので、BGR配列を1回のSIMD変換で作って渡す
+
+    Returns:
+        image: RGB配列（SegFormer/LaMa/デバッグ用）
+        image_bgr: FastSAMに渡すBGR配列
+        original_size: 縮小前の(width, height)
+    """
+    image, original_size = decode_image(image_data, max_size)
+    return image, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), original_size
+
+
+def encode_jpeg(rgb: np.ndarray, quality: int = 85) -> bytes:
+    """RGB配列をJPEGにエンコード（切り出したビューも受け付ける）"""
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(np.ascontiguousarray(rgb), quality=quality, pixel_format=TJPF_RGB)
+    _, buffer = cv2.imencode(".jpg", cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def encode_mask_png(mask: np.ndarray) -> bytes:
+    """
+    二値マスクを1bitグレースケールPNGにエンコード（0以外は白、デコードすると0/255）
+    8bitで書いてzlibに冗長さを消させるより、libpngに1bitでパックさせる方が速くて小さい
+    """
+    _, buffer = cv2.imencode(".png", mask, [
+        cv2.IMWRITE_PNG_BILEVEL, 1,
+        cv2.IMWRITE_PNG_COMPRESSION, 1,
+        cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE,
+    ])
+    return buffer.tobytes()
+
+
+def encode_mask_rle(mask: np.ndarray) -> bytes:
+    """
+    二値マスクを行優先のランレングスにエンコード（zlibを使わないので速い）
+    0のランから始めて0/1を交互に並べたランの長さを、リトルエンディアンのuint32列で返す
+    """
+    flat = mask.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    lengths = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        lengths = np.concatenate(([0], lengths))  # 先頭が1なら長さ0の0ランを入れる
+    return lengths.astype("<u4").tobytes()
+
+
+def encode_mask(mask: np.ndarray, mask_format: str) -> bytes:
+    """mask_formatに応じてマスクをPNG（1bit）かランレングスにエンコード"""
+    return encode_mask_rle(mask) if mask_format == "rle" else encode_mask_png(mask)
+
+
+def encode_mask_sprite(masks: list[np.ndarray]) -> tuple[bytes, list[int]]:
+    """
+    マスクを縦に並べた1枚のスプライトシートとしてPNGエンコード
+
+    Returns:
+        sprite_png: スプライトシートのPNGバイト列（幅は最大のマスク幅）
+        offsets: 各マスクの開始y座標
+    """
+    offsets = np.cumsum([0] + [m.shape[0] for m in masks]).tolist()
+    sprite = np.zeros((offsets[-1], max(m.shape[1] for m in masks)), dtype=np.uint8)
+    for mask, y in zip(masks, offsets):
+        sprite[y:y + mask.shape[0], :mask.shape[1]] = mask
+    return encode_mask_png(sprite), offsets[:-1]
+
+
+def encode_mask_packed(masks: list[np.ndarray]) -> tuple[bytes, list[int]]:
+    """
+    マスクを1ピクセル1ビットにビットパックして1つのバッファに連結（圧縮しないのでPNGより速い）
+    各マスクは行優先、各行はMSBから詰めてバイト境界までパディングする（1行 = ceil(width / 8) バイト）
+
+    Returns:
+        packed: 連結したバイト列
+        offsets: 各マスクの開始バイト位置
+    """
+    # np.packbitsは0以外を1として扱うので、0/1のクロップをそのまま渡せる
+    packed = [np.packbits(mask, axis=-1) for mask in masks]
+    offsets = np.cumsum([0] + [p.size for p in packed]).tolist()
+    return np.concatenate([p.ravel() for p in packed]).tobytes(), offsets[:-1]
+
+
+def encode_base64(data: bytes | None) -> str | None:
+    """バイト列をBase64文字列に変換（Noneはそのまま返す）"""
+    return pybase64.b64encode_as_string(data) if data is not None else None
+
+
+def encode_jpeg_base64(rgb: np.ndarray | None, quality: int = 85) -> str | None:
+    """RGB配列をJPEGにエンコードしてBase64文字列で返す（Noneはそのまま返す）"""
+    return encode_base64(encode_jpeg(rgb, quality=quality)) if rgb is not None else None
+
+
+def encode_mask_payload(mask_data: dict, mask_format: str = "png") -> dict:
+    """マスク(0/1配列)をPNG、補完領域(RGB配列)をJPEGにエンコードし、Base64にしたレスポンス用dictを返す"""
+    mask = mask_data["data"]
+    return {
+        **mask_data,
+        "data": encode_base64(encode_mask(mask, mask_format)) if mask is not None else None,
+        "inpaint_data": encode_jpeg_base64(mask_data["inpaint_data"]),
+    }
+
+
+@lru_cache(maxsize=16)
+def get_dilation_kernel(dilate_pixels: int) -> np.ndarray:
+    """膨張用の楕円カーネルを取得（dilate_pixelsごとにキャッシュ、リクエスト間で共有するため書き込み禁止にする）"""
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_pixels * 2 + 1, dilate_pixels * 2 + 1))
+    kernel.setflags(write=False)
+    return kernel
+
+
+def tensor_to_numpy(tensor: torch.Tensor) -> np.ndarray:
+    """
+    デバイス上のテンソルをnumpy配列として取得
+    CUDAでは通常のメモリへコピーするとドライバ内部のステージングを挟むので、ピン留めメモリ（PyTorchがキャッシュして再利用）へ直接DMAする
+    """
+    if tensor.device.type != "cuda":
+        return tensor.cpu().numpy()
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    torch.cuda.current_stream(tensor.device).synchronize()
+    return host.numpy()
+
+
+def image_to_tensor(image_array: np.ndarray) -> torch.Tensor:
+    """(H, W, 3)のRGB配列を(1, 3, H, W)の0-1 floatテンソルとして推論デバイスに転送"""
+    array = torch.from_numpy(image_array)
+    if DEVICE == "cuda":
+        # ピン留めメモリからの転送はnon_blockingで非同期になる
+        array = array.pin_memory()
+    return array.to(DEVICE, non_blocking=True).permute(2, 0, 1).unsqueeze(0).float().div_(255)
+
+
+def tensor_to_image(tensor: torch.Tensor) -> Image.Image:
+    """(1, 3, H, W)の0-1テンソルをPIL画像に変換"""
+    array = tensor[0].clamp(0, 1).mul(255).round_().to(torch.uint8).permute(1, 2, 0)
+    return Image.fromarray(tensor_to_numpy(array))
+
+
+def run_lama(image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """
+    SimpleLamaのPIL変換を通さずにLaMa本体を実行
+
+    Args:
+        image: (1, 3, H, W)の0-1テンソル
+        mask: (1, 1, H, W)のテンソル（0より大きい画素を補完）
+
+    Returns:
+        (1, 3, H, W)の補完済み画像テンソル
+    """
+    height, width = image.shape[2:]
+    # LaMaは8の倍数サイズを要求するためパディング
+    pad_h = -height % 8
+    pad_w = -width % 8
+    if pad_h or pad_w:
+        image = F.pad(image, (0, pad_w, 0, pad_h), mode="replicate")
+        mask = F.pad(mask, (0, pad_w, 0, pad_h), mode="replicate")
+    lama_forward = lama_openvino if lama_openvino is not None else lama_model.model
+    with torch.inference_mode():
+        inpainted = lama_forward(image, (mask > 0).float())
+    return inpainted[:, :, :height, :width]
+
+
+def inpaint_to_image(image_array: np.ndarray, mask: np.ndarray, inpaint_hw: tuple[int, int]) -> Image.Image:
+    """
+    LaMaで補完し、元画像サイズに拡大したPIL画像を返す
+    デバイスへの転送・同期もイベントループを塞がないよう、全体をスレッドプールから呼ぶ
+
+    Args:
+        image_array: (H, W, 3)のRGB配列
+        mask: inpaint_hwの0/1 uint8マスク（膨張済み）
+        inpaint_hw: LaMaを実行する解像度 (H, W)
+    """
+    output_hw = image_array.shape[:2]
+    # Upload the image to the inference device once and scale it down there (no PIL round-trip)
+    image_tensor = image_to_tensor(image_array)
+    if inpaint_hw != output_hw:
+        reduce_factor = max(1, round(output_hw[1] / inpaint_hw[1]))
+        if (output_hw[0] // reduce_factor, output_hw[1] // reduce_factor) == tuple(inpaint_hw):
+            # 1/2, 1/4などの整数比はPILのreduceと同じボックス平均で縮小（補間より軽い）
+            image_tensor = F.avg_pool2d(image_tensor, kernel_size=reduce_factor)
+        else:
+            image_tensor = F.interpolate(image_tensor, size=inpaint_hw, mode="bilinear", antialias=True, align_corners=False)
+    mask_tensor = torch.from_numpy(mask).to(DEVICE)[None, None].float()
+
+    inpainted = run_lama(image_tensor, mask_tensor)
+    if tuple(inpainted.shape[2:]) != output_hw:
+        inpainted = F.interpolate(inpainted, size=output_hw, mode="bicubic", align_corners=False)
+    return tensor_to_image(inpainted)
+
+
+def get_background_mask_segformer(image: Image.Image, with_predicted: bool = False) -> tuple[torch.Tensor, np.ndarray | None]:
+    """
+    SegFormerで壁/床/天井のマスクを取得
+
+    Returns:
+        background_mask: 背景マスク（推論デバイス上のuint8テンソル、SegFormer出力解像度）
+        predicted: 全クラスの予測マップ（デバッグ用、uint8のnumpy配列。with_predicted=Falseなら None）
+    """
+    segformer_processor, segformer_model = get_segformer()
     inputs = segformer_processor(images=image, return_tensors="pt")
-    with torch.no_grad():
-        outputs = segformer_model(**inputs)
-    logits = outputs.logits  # (1, num_classes, H, W)
+    inputs = {
+        k: v.to(DEVICE, dtype=segformer_model.dtype) if v.is_floating_point() else v.to(DEVICE)
+        for k, v in inputs.items()
+    }
+    with torch.inference_mode():
+        logits = segformer_model(**inputs).logits  # (1, num_classes, H, W)
+
+        # 最も確率の高いクラスを取得（ADE20Kは150クラスなのでuint8に収まる）
+        predicted = logits.argmax(dim=1)[0].to(torch.uint8)
+
+        # 背景クラス（壁/床/天井）に該当するピクセルをマスク
+        background_mask = torch.isin(predicted, BACKGROUND_CLASS_IDS_TENSOR).to(torch.uint8)
+
+    # 背景マスクはデバイス上に残し、使う解像度にリサイズしてから転送する
+    return background_mask, tensor_to_numpy(predicted) if with_predicted else None
 
-    # 最も確率の高いクラスを取得
-    predicted = logits.argmax(dim=1).squeeze().cpu().numpy()
 
-    # 背景クラス（壁/床/天井）に該当するピクセルをマスク
-    background_mask = np.isin(predicted, BACKGROUND_CLASS_IDS)
+def resize_mask_on_device(mask: torch.Tensor, size: tuple[int, int]) -> np.ndarray:
+    """デバイス上のマスクを(H, W)にNEARESTでリサイズしてからnumpy配列として取得"""
+    resized = F.interpolate(mask[None, None].float(), size=size, mode="nearest")
+    return tensor_to_numpy(resized[0, 0].to(torch.uint8))
 
-    return background_mask.astype(np.uint8), predicted
+
+def segformer_background_mask(image: Image.Image, size: tuple[int, int], with_predicted: bool = False) -> tuple[np.ndarray, np.ndarray | None]:
+    """SegFormerの背景マスクを(H, W)にリサイズして取得（segformer_executorから呼ぶ）"""
+    background_mask, predicted = get_background_mask_segformer(image, with_predicted=with_predicted)
+    return resize_mask_on_device(background_mask, size), predicted
 
 
 def filter_masks_by_background(
@@ -225,37 +646,214 @@ def filter_masks_by_background(
         filtered_indices: 保持するマスクのインデックス
         overlap_ratios: 各マスクの背景との重複率
     """
-    # background_maskをFastSAMマスクサイズにリサイズ
+    # background_maskをFastSAMマスクサイズにリサイズ（呼び出し側で合わせてあれば不要）
     mask_h, mask_w = fastsam_masks[0].shape
-    bg_resized = cv2.resize(
-        background_mask,
-        (mask_w, mask_h),
-        interpolation=cv2.INTER_NEAREST
-    )
+    bg_resized = background_mask
+    if bg_resized.shape != (mask_h, mask_w):
+        bg_resized = cv2.resize(
+            background_mask,
+            (mask_w, mask_h),
+            interpolation=cv2.INTER_NEAREST
+        )
+
+    # マスクと背景をビットパックして1ピクセル1ビットで重複を数える
+    num_masks = len(fastsam_masks)
+    # np.packbitsは0以外を1として詰めるので、0/1のuint8マスクは閾値処理やboolへの変換パスなしで直接渡す
+    if fastsam_masks.dtype != np.uint8:
+        fastsam_masks = fastsam_masks > 0.5
+    mask_bits = np.packbits(fastsam_masks, axis=-1).reshape(num_masks, -1)
+    bg_bits = np.packbits(bg_resized, axis=-1).reshape(1, -1)
+    mask_areas = POPCOUNT_LUT[mask_bits].sum(axis=1)
+    overlaps = POPCOUNT_LUT[mask_bits & bg_bits].sum(axis=1)
 
     filtered_indices = []
     overlap_ratios = []
 
-    for i, mask in enumerate(fastsam_masks):
-        binary_mask = (mask > 0.5).astype(np.uint8)
-        mask_area = np.sum(binary_mask)
-        if mask_area == 0:
+    for i in range(num_masks):
+        if mask_areas[i] == 0:
             overlap_ratios.append(0.0)
             continue
 
-        # 背景との重複率を計算
-        overlap = np.sum(binary_mask & bg_resized)
-        overlap_ratio = overlap / mask_area
+        # 背景との重複率
+        overlap_ratio = float(overlaps[i] / mask_areas[i])
         overlap_ratios.append(overlap_ratio)
 
         if overlap_ratio < threshold:
             filtered_indices.append(i)
         else:
-            print(f"[HTTP] Excluded mask {i}: {overlap_ratio:.1%} overlap with wall/floor/ceiling")
+            print(f"[Background] Excluded mask {i}: {overlap_ratio:.1%} overlap with wall/floor/ceiling")
 
     return filtered_indices, overlap_ratios
 
 
+# (image, conf, iou, max_masks, keep_raw, future) のキュー（lifespanで作成）
+fastsam_queue: asyncio.Queue | None = None
+fastsam_worker: asyncio.Task | None = None
+
+# 推論パイプライン（FastSAM/SegFormer/LaMa）に同時に入るリクエスト数の上限（lifespanで作成）
+# FastSAMはワーカーで直列化されるが、SegFormer/LaMaはリクエストごとにスレッドで走るのでVRAMを食い潰さないよう抑える
+# 待っている間/wsは次のフレームを受信しないので、クライアントにはWebSocketのフロー制御で背圧がかかる
+MAX_CONCURRENT_INFERENCE = FASTSAM_MAX_BATCH * 2
+inference_semaphore: asyncio.Semaphore | None = None
+
+
+def filter_fastsam_result(result, conf: float, iou: float):
+    """バッチ用の緩い閾値で得た結果を、リクエストごとのconf/iouで絞り込む"""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return result
+    keep = torch.nonzero(boxes.conf >= conf).flatten()
+    keep = keep[torchvision.ops.nms(boxes.xyxy[keep], boxes.conf[keep], iou)]
+    return result[keep]
+
+
+def fastsam_result_to_host(result, max_masks: int, keep_raw: bool) -> dict | None:
+    """
+    FastSAMの結果をデバイス上で0/1に閾値処理し、ホストのnumpy配列に転送
+    転送はデバイスの同期を伴うので、イベントループではなくスレッドプールから呼ぶ
+
+    Returns:
+        マスクがなければNone。あれば以下のdict
+        bin_masks: 上位max_masks個の0/1 uint8マスク (K, H, W)
+        raw_masks: 全マスクの0/1 uint8マスク（デバッグ用、keep_raw=FalseならNone）
+        boxes: (N, 4)のxyxy（なければNone）
+        num_masks: 閾値処理前のマスク数
+    """
+    if result.masks is None or len(result.masks) == 0:
+        return None
+    masks = result.masks.data  # (N, H, W) soft masks, still on the inference device
+    # Threshold on the device and transfer as 0/1 uint8 (1 byte/px instead of fp16/fp32);
+    # the background filter and the area filter share it
+    return {
+        "bin_masks": tensor_to_numpy((masks[:max_masks] > 0.5).to(torch.uint8)),
+        "raw_masks": tensor_to_numpy((masks > 0.5).to(torch.uint8)) if keep_raw else None,
+        "boxes": tensor_to_numpy(result.boxes.xyxy) if result.boxes is not None else None,
+        "num_masks": len(masks),
+    }
+
+
+def postprocess_fastsam_batch(batch: list[tuple], results: list, batch_conf: float, batch_iou: float) -> list:
+    """
+    バッチの結果をリクエストごとのconf/iouで絞り込み、ホストに転送（スレッドプールから呼ぶ）
+    失敗したリクエストは例外オブジェクトをそのまま返し、他のリクエストには影響させない
+    """
+    outputs = []
+    for (_, conf, iou, max_masks, keep_raw, _), result in zip(batch, results):
+        try:
+            if conf != batch_conf or iou != batch_iou:
+                result = filter_fastsam_result(result, conf, iou)
+            outputs.append(fastsam_result_to_host(result, max_masks, keep_raw))
+        except Exception as e:
+            outputs.append(e)
+    return outputs
+
+
+def predict_fastsam(images: list[np.ndarray], conf: float, iou: float) -> list:
+    """
+    FastSAMでバッチ推論（スレッドプールから呼ぶ。autocastはスレッドローカルなのでここで有効にする）
+    imagesはultralyticsのndarray入力の規約どおりBGR
+    """
+    with torch.autocast("cpu", dtype=torch.bfloat16, enabled=USE_CPU_BF16):
+        results = model(
+            images,
+            device=DEVICE,
+            half=USE_HALF,
+            retina_masks=True,
+            imgsz=640,
+            conf=conf,
+            iou=iou,
+        )
+    if USE_CPU_BF16:
+        # numpyはbfloat16を扱えないので後段のためにfloat32に戻す
+        for result in results:
+            if result.masks is not None:
+                result.update(boxes=result.boxes.data.float(), masks=result.masks.data.float())
+    return results
+
+
+def warmup_models():
+    """FastSAMとLaMaをダミー画像で一度推論して、初回実行時のコストを起動時に済ませる"""
+    print("Warming up models...")
+    warmup_start = time.perf_counter()
+    # TensorRTエンジンは初回に実行コンテキストを確保するため2回流す（以降はimgsz=640固定で同じ形状を再利用）
+    for _ in range(2):
+        predict_fastsam([np.zeros((640, 640, 3), dtype=np.uint8)], conf=0.4, iou=0.9)
+    warmup_image = torch.zeros((1, 3, 512, 512), device=DEVICE)
+    warmup_mask = torch.zeros((1, 1, 512, 512), device=DEVICE)
+    warmup_mask[:, :, 192:320, 192:320] = 1
+    run_lama(warmup_image, warmup_mask)
+    print(f"Warmup done in {time.perf_counter() - warmup_start:.3f}s")
+
+
+async def fastsam_batch_worker():
+    """キューに溜まったリクエストをまとめてFastSAMに流し、各futureに結果を返す"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await fastsam_queue.get()]
+        deadline = loop.time() + FASTSAM_BATCH_WINDOW
+        while len(batch) < FASTSAM_MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(fastsam_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            await process_fastsam_batch(batch)
+        except Exception as e:
+            # 想定外の例外でもワーカーは止めず、このバッチの待ち手にだけ返す
+            print(f"[FastSAM] Batch failed: {e!r}")
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+async def process_fastsam_batch(batch: list[tuple]):
+    """1バッチをFastSAMで推論し、リクエストごとに絞り込んだ結果を各futureに返す"""
+    # バッチ内で最も緩い閾値で推論し、後からリクエストごとに絞り込む
+    batch_conf = min(item[1] for item in batch)
+    batch_iou = max(item[2] for item in batch)
+    results = await asyncio.to_thread(predict_fastsam, [item[0] for item in batch], batch_conf, batch_iou)
+
+    # NMSと閾値処理、ホストへの転送はデバイスの同期を伴うので、これもスレッドで行う
+    outputs = await asyncio.to_thread(postprocess_fastsam_batch, batch, results, batch_conf, batch_iou)
+
+    if len(batch) > 1:
+        print(f"[FastSAM] Batch of {len(batch)} requests")
+    for (*_, future), output in zip(batch, outputs):
+        # 切断などでキャンセル済みのfutureには結果を入れない
+        if future.done():
+            continue
+        if isinstance(output, Exception):
+            future.set_exception(output)
+        else:
+            future.set_result(output)
+
+
+def start_fastsam_worker():
+    """FastSAMのバッチワーカーを起動（例外で終了したら再起動する）"""
+    global fastsam_worker
+    fastsam_worker = asyncio.create_task(fastsam_batch_worker())
+    fastsam_worker.add_done_callback(on_fastsam_worker_done)
+
+
+def on_fastsam_worker_done(task: asyncio.Task):
+    """ワーカーが止まったままだとrun_fastsamが永遠に待つので、ログを出して再起動する"""
+    if task.cancelled():
+        return
+    print(f"[FastSAM] Batch worker stopped unexpectedly: {task.exception()!r}, restarting")
+    start_fastsam_worker()
+
+
+async def run_fastsam(image: np.ndarray, conf: float, iou: float, max_masks: int, keep_raw: bool = False) -> dict | None:
+    """FastSAMのバッチワーカーに画像（BGR配列）を渡し、ホストに転送済みの結果（fastsam_result_to_host）を待つ"""
+    future = asyncio.get_running_loop().create_future()
+    await fastsam_queue.put((image, conf, iou, max_masks, keep_raw, future))
+    return await future
+
+
 @app.get("/")
 async def root():
     """ヘルスチェック用エンドポイント"""
@@ -269,245 +867,244 @@ async def root():
     }
 
 
-@app.post("/segment")
-async def segment_image(request: SegmentRequest):
+async def run_segmentation(
+    request: SegmentRequest,
+    image_data: bytes,
+    log_tag: str = "HTTP",
+) -> dict:
     """
-    HTTP POST エンドポイント: 画像をセグメンテーション
-    WebXRからの一回限りのリクエスト用
-    """
-    start_time = datetime.now()
+    FastSAM → 背景除外 → 面積フィルタ → LaMa補完までを実行（HTTP/WebSocket共通）
 
-    try:
-        # Base64デコード
-        image_data = base64.b64decode(request.image)
-        image = Image.open(BytesIO(image_data))
-
-        print(f"[HTTP] Processing image: {image.size}, conf={request.conf}, iou={request.iou}, min_area={request.min_area}, exclude_background={request.exclude_background}")
+    Args:
+        request: リクエストパラメータ（imageは使わない）
+        image_data: エンコード済みの画像バイト列（JPEG/PNG）
+        log_tag: ログの接頭辞
 
-        # FastSAMで推論
-        results = model(
-            image,
-            device="cpu",
-            retina_masks=True,
-            imgsz=640,
-            conf=request.conf,
-            iou=request.iou,
-        )
+    Returns:
+        masks: レスポンス用のマスク情報（data/inpaint_dataはエンコード前の配列）
+        mask_sprite: スプライトシートのPNGバイト列（mask_format="sprite"のときのみ）
+        mask_packed: ビットパックしたマスクのバイト列（mask_format="packed"のときのみ）
+        combined_inpaint: 全体の補完結果のRGB配列（combined_inpaintのときのみ）
+        image_size: [width, height]（max_image_size指定時は縮小後）
+        original_image_size: 縮小前の[width, height]
+    """
+    image_array, image_bgr, original_size = await asyncio.to_thread(decode_image_for_fastsam, image_data, request.max_image_size)
+    # PILが必要な箇所（SegFormer/デバッグ保存）向けに配列をそのまま包む
+    image = Image.fromarray(image_array)
+
+    print(f"[{log_tag}] Processing image: {image.size}, conf={request.conf}, iou={request.iou}, min_area={request.min_area}, exclude_background={request.exclude_background}")
+
+    # FastSAMで推論（同時に来たリクエストとまとめてバッチ推論）
+    result = await run_fastsam(image_bgr, request.conf, request.iou, request.max_masks, keep_raw=request.debug)
+    del image_bgr  # 推論後は不要なので、補完の間に全画素分のコピーを持ち続けない
+
+    masks_data = []
+    mask_sprite = None
+    mask_packed = None
+    combined_inpaint_array = None  # RGB array of the combined inpaint result (JPEG-encoded at the end)
+    combined_inpainted = None  # PIL Image for debug saving
+    raw_masks = None  # 0/1 uint8 array of all masks for debug visualization (debug only)
+    background_mask = None  # SegFormerの背景マスク（デバッグ用）
+    segformer_predicted = None  # SegFormerの全クラス予測（デバッグ用）
+
+    if result is not None:
+        # Masks arrive thresholded to 0/1 uint8 on the host (see fastsam_result_to_host)
+        bin_masks = result["bin_masks"]
+        raw_masks = result["raw_masks"]
+        boxes = result["boxes"]
+
+        # Use mask dimensions for area calculation (FastSAM output size)
+        mask_height, mask_width = bin_masks.shape[1:]
+        total_area = mask_width * mask_height
+
+        print(f"[{log_tag}] Mask array shape: {(result['num_masks'], mask_height, mask_width)}, total_area={total_area}, min_area threshold={request.min_area}")
+        print(f"[{log_tag}] Total masks before filtering: {result['num_masks']}")
+        print(f"[{log_tag}] Inpaint mode: {'combined' if request.combined_inpaint else 'individual'}, dilate: {request.dilate_pixels}px")
+
+        # 背景除外フィルタリング
+        background_excluded_indices = None
+        if request.exclude_background == "segformer":
+            print(f"[{log_tag}] Running SegFormer for background detection...")
+            segformer_start = time.perf_counter()
+            # SegFormerの推論も同期呼び出しなので、専用スレッドで実行してイベントループを塞がない
+            # FastSAMマスクの解像度で一度だけリサイズし、フィルタとデバッグ画像で共有
+            background_mask, segformer_predicted = await asyncio.get_running_loop().run_in_executor(
+                segformer_executor, segformer_background_mask, image, (mask_height, mask_width), request.debug
+            )
+            segformer_time = time.perf_counter() - segformer_start
+            print(f"[{log_tag}] SegFormer done in {segformer_time:.3f}s")
 
-        masks_data = []
-        combined_inpaint_data = None
-        combined_inpainted = None  # PIL Image for debug saving
-        raw_masks = None  # numpy array for debug visualization
-        background_mask = None  # SegFormerの背景マスク（デバッグ用）
-        segformer_predicted = None  # SegFormerの全クラス予測（デバッグ用）
-
-        if results[0].masks is not None:
-            masks = results[0].masks.data.cpu().numpy()
-            raw_masks = masks  # Store for debug visualization
-            boxes = results[0].boxes.xyxy.cpu().numpy() if results[0].boxes is not None else None
-
-            # Use mask dimensions for area calculation (FastSAM output size)
-            mask_height, mask_width = masks[0].shape if len(masks) > 0 else (1, 1)
-            total_area = mask_width * mask_height
-
-            print(f"[HTTP] Mask array shape: {masks.shape}, total_area={total_area}, min_area threshold={request.min_area}")
-            print(f"[HTTP] Total masks before filtering: {len(masks)}")
-            print(f"[HTTP] Inpaint mode: {'combined' if request.combined_inpaint else 'individual'}, dilate: {request.dilate_pixels}px")
-
-            # 背景除外フィルタリング
-            background_excluded_indices = None
-            if request.exclude_background == "segformer":
-                print("[HTTP] Running SegFormer for background detection...")
-                segformer_start = datetime.now()
-                background_mask, segformer_predicted = get_background_mask_segformer(image)
-                segformer_time = (datetime.now() - segformer_start).total_seconds()
-                print(f"[HTTP] SegFormer done in {segformer_time:.3f}s")
-
-                background_excluded_indices, overlap_ratios = filter_masks_by_background(
-                    masks[:request.max_masks],
-                    background_mask,
-                    request.background_overlap_threshold
-                )
-                print(f"[HTTP] Background filter: {len(masks[:request.max_masks])} -> {len(background_excluded_indices)} masks")
-            elif request.exclude_background == "heuristic":
-                # 将来の拡張用
-                print("[HTTP] Heuristic background filter not implemented yet")
-                background_excluded_indices = list(range(min(len(masks), request.max_masks)))
+            background_excluded_indices, overlap_ratios = await asyncio.to_thread(
+                filter_masks_by_background,
+                bin_masks,
+                background_mask,
+                request.background_overlap_threshold
+            )
+            print(f"[{log_tag}] Background filter: {len(bin_masks)} -> {len(background_excluded_indices)} masks")
+        elif request.exclude_background == "heuristic":
+            # 将来の拡張用
+            print(f"[{log_tag}] Heuristic background filter not implemented yet")
+            background_excluded_indices = list(range(len(bin_masks)))
+        else:
+            # フィルタリングなし
+            background_excluded_indices = list(range(len(bin_masks)))
+
+        # First pass: filter masks with batched reductions over all candidates
+        # cv2.countNonZeroはSIMDで数えるため、uint8のsum(uint64に昇格)より大幅に速い
+        areas = np.array([cv2.countNonZero(m) for m in bin_masks], dtype=np.int64)
+        area_ratios = areas / total_area
+        keep = area_ratios >= request.min_area
+        # 背景フィルタで除外されたマスクもスキップ
+        keep &= np.isin(np.arange(len(bin_masks)), background_excluded_indices)
+        keep_idx = np.flatnonzero(keep)
+        skipped_count = len(bin_masks) - len(keep_idx)
+
+        print(f"[{log_tag}] Keeping masks {keep_idx.tolist()}: ratios={[round(float(r), 4) for r in area_ratios[keep_idx]]}")
+
+        filtered_masks = [
+            {
+                "original_idx": int(i),
+                "mask_id": mask_id,
+                "binary_mask": bin_masks[i],
+                "bbox": boxes[i].tolist() if boxes is not None and i < len(boxes) else None,
+            }
+            for mask_id, i in enumerate(keep_idx)
+        ]
+
+        # Merge all masks and inpaint once. Individual mode crops per-mask
+        # regions out of the same result, since LaMa leaves pixels outside the mask as-is
+        if len(filtered_masks) > 0:
+            try:
+                # Combine all masks into one, OR-ing in place so the kept masks are never gathered into a copy
+                combined_mask = bin_masks[keep_idx[0]].copy()
+                for i in keep_idx[1:]:
+                    cv2.bitwise_or(combined_mask, bin_masks[i], dst=combined_mask)
+
+                # Scale down for faster inpainting (the image is resized on device inside inpaint_to_image)
+                # Individual mode keeps full resolution as before
+                inpaint_scale = max(0.25, min(1.0, request.inpaint_scale)) if request.combined_inpaint else 1.0
+                original_hw = (image.size[1], image.size[0])
+                if inpaint_scale < 1.0:
+                    scaled_hw = (int(original_hw[0] * inpaint_scale), int(original_hw[1] * inpaint_scale))
+                    print(f"[{log_tag}] Inpainting at {inpaint_scale:.0%} scale: {scaled_hw[1]}x{scaled_hw[0]}")
+                else:
+                    scaled_hw = original_hw
+                # Resize the uint8 mask on the host before upload, so only the
+                # inpaint-resolution mask is transferred and cast to float
+                mask_scale = scaled_hw[1] / combined_mask.shape[1]
+                if mask_scale < 1.0:
+                    # 縮小はINTER_AREAで少しでも被るピクセルを残す（細い部分が消えないように）
+                    combined_mask = cv2.resize(combined_mask * 255, (scaled_hw[1], scaled_hw[0]), interpolation=cv2.INTER_AREA)
+                    combined_mask = (combined_mask > 0).view(np.uint8)
+                elif combined_mask.shape != scaled_hw:
+                    combined_mask = cv2.resize(combined_mask, (scaled_hw[1], scaled_hw[0]), interpolation=cv2.INTER_NEAREST)
+
+                # Dilate at inpaint resolution with the radius scaled to match
+                # (kernel area shrinks by scale^2; the radius is accurate to one inpaint-resolution pixel)
+                if request.dilate_pixels > 0:
+                    dilate_scaled = max(1, round(request.dilate_pixels * mask_scale))
+                    kernel = get_dilation_kernel(dilate_scaled)
+                    combined_mask = cv2.dilate(combined_mask, kernel, iterations=1)
+
+                # Run LaMa inpainting once for all masks
+                print(f"[{log_tag}] Running combined inpainting...")
+                inpaint_start = time.perf_counter()
+                # Upload, LaMa and the upscale back to original size run on the threadpool
+                # so other requests keep being served meanwhile
+                combined_inpainted = await asyncio.to_thread(inpaint_to_image, image_array, combined_mask, scaled_hw)
+                inpaint_time = time.perf_counter() - inpaint_start
+                print(f"[{log_tag}] Combined inpainting done in {inpaint_time:.3f}s")
+
+                # Full inpainted image is JPEG-encoded together with the masks below
+                if request.combined_inpaint:
+                    combined_inpaint_array = np.asarray(combined_inpainted)
+
+            except Exception as e:
+                print(f"[{log_tag}] Combined inpainting failed: {e}")
+
+        # Build mask data
+        # 画像サイズとマスク座標への倍率は全マスク共通なのでループの外で一度だけ求める
+        image_width, image_height = image.size
+        scale_x = mask_width / image_width
+        scale_y = mask_height / image_height
+        sprite_crops = []
+        for fm in filtered_masks:
+            binary_mask = fm["binary_mask"]
+            bbox = fm["bbox"]
+            mask_id = fm["mask_id"]
+
+            # Crop mask to bbox region
+            if bbox is not None:
+                x1, y1, x2, y2 = [int(v) for v in bbox]
+                # Clamp to image bounds
+                x1 = max(0, x1)
+                y1 = max(0, y1)
+                x2 = min(image_width, x2)
+                y2 = min(image_height, y2)
             else:
-                # フィルタリングなし
-                background_excluded_indices = list(range(min(len(masks), request.max_masks)))
-
-            # First pass: filter masks and collect data
-            filtered_masks = []
-            mask_id = 0
-            skipped_count = 0
-            for i, mask in enumerate(masks[:request.max_masks]):
-                # 背景フィルタで除外されたマスクはスキップ
-                if i not in background_excluded_indices:
-                    skipped_count += 1
-                    continue
-                # Calculate actual mask area by counting non-zero pixels
-                binary_mask = (mask > 0.5).astype(np.uint8)
-                mask_pixel_count = int(np.sum(binary_mask))
-                mask_area_ratio = mask_pixel_count / total_area
-
-                # Filter out small masks
-                if mask_area_ratio < request.min_area:
-                    print(f"[HTTP] Skipping mask {i}: pixels={mask_pixel_count}, ratio={mask_area_ratio:.4f} < {request.min_area}")
-                    skipped_count += 1
-                    continue
-
-                print(f"[HTTP] Keeping mask {i}: pixels={mask_pixel_count}, ratio={mask_area_ratio:.4f}")
-
-                # Get bounding box
-                bbox = boxes[i].tolist() if boxes is not None and i < len(boxes) else None
-
-                filtered_masks.append({
-                    "original_idx": i,
-                    "mask_id": mask_id,
-                    "binary_mask": binary_mask,
-                    "bbox": bbox,
-                })
-                mask_id += 1
-
-            # Combined inpainting mode: merge all masks and inpaint once
-            if request.combined_inpaint and len(filtered_masks) > 0:
+                x1, y1, x2, y2 = 0, 0, image_width, image_height
+            crop_width = x2 - x1
+            crop_height = y2 - y1
+
+            # Crop in mask space first, then resize only the crop to image resolution
+            mx1, my1 = int(x1 * scale_x), int(y1 * scale_y)
+            mx2 = max(mx1 + 1, int(np.ceil(x2 * scale_x)))
+            my2 = max(my1 + 1, int(np.ceil(y2 * scale_y)))
+            # The 1-bit PNG encoder treats any nonzero pixel as white, so the 0/1 crop
+            # is encoded as-is (no *255 pass); without a resize it stays a zero-copy view
+            mask_cropped = binary_mask[my1:my2, mx1:mx2]
+            if mask_cropped.shape != (crop_height, crop_width):
+                mask_cropped = cv2.resize(mask_cropped, (crop_width, crop_height), interpolation=cv2.INTER_NEAREST)
+
+            # PNG encoding happens on the threadpool after the loop (sprite/packed modes pack all crops into one buffer)
+            if request.mask_format in ("sprite", "packed"):
+                sprite_crops.append(mask_cropped)
+                mask_cropped = None
+
+            # Individual inpainting (only if not using combined mode)
+            inpaint_data = None
+            inpaint_bbox = None
+            if not request.combined_inpaint and bbox is not None and combined_inpainted is not None:
                 try:
-                    # Combine all masks into one
-                    combined_mask = np.zeros((mask_height, mask_width), dtype=np.uint8)
-                    for fm in filtered_masks:
-                        combined_mask = np.maximum(combined_mask, fm["binary_mask"])
-
-                    # Dilate the combined mask
-                    if request.dilate_pixels > 0:
-                        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (request.dilate_pixels * 2 + 1, request.dilate_pixels * 2 + 1))
-                        combined_mask = cv2.dilate(combined_mask, kernel, iterations=1)
-
-                    # Resize to original image size
-                    combined_mask_img = Image.fromarray(combined_mask * 255)
-                    combined_mask_resized = combined_mask_img.resize(image.size, Image.Resampling.NEAREST)
-
-                    # Scale down for faster inpainting
-                    inpaint_scale = max(0.25, min(1.0, request.inpaint_scale))
-                    original_size = image.size
-                    if inpaint_scale < 1.0:
-                        scaled_size = (int(original_size[0] * inpaint_scale), int(original_size[1] * inpaint_scale))
-                        image_scaled = image.resize(scaled_size, Image.Resampling.LANCZOS)
-                        mask_scaled = combined_mask_resized.resize(scaled_size, Image.Resampling.NEAREST)
-                        print(f"[HTTP] Inpainting at {inpaint_scale:.0%} scale: {scaled_size[0]}x{scaled_size[1]}")
-                    else:
-                        image_scaled = image
-                        mask_scaled = combined_mask_resized
-
-                    # Run LaMa inpainting once for all masks
-                    print(f"[HTTP] Running combined inpainting...")
-                    inpaint_start = datetime.now()
-                    inpainted_scaled = lama_model(image_scaled, mask_scaled)
-                    inpaint_time = (datetime.now() - inpaint_start).total_seconds()
-                    print(f"[HTTP] Combined inpainting done in {inpaint_time:.3f}s")
-
-                    # Scale back up to original size if needed
-                    if inpaint_scale < 1.0:
-                        combined_inpainted = inpainted_scaled.resize(original_size, Image.Resampling.LANCZOS)
-                    else:
-                        combined_inpainted = inpainted_scaled
-
-                    # Encode full inpainted image as JPEG
-                    inpaint_buffered = BytesIO()
-                    combined_inpainted.save(inpaint_buffered, format="JPEG", quality=85)
-                    combined_inpaint_data = base64.b64encode(inpaint_buffered.getvalue()).decode()
+                    # Expand bbox and crop the region out of the shared inpaint result
+                    inpaint_bbox = expand_bbox(bbox, (image_width, image_height), padding_ratio=0.15)
+                    crop_x1, crop_y1, crop_x2, crop_y2 = inpaint_bbox
+                    inpaint_data = np.asarray(combined_inpainted)[crop_y1:crop_y2, crop_x1:crop_x2]
 
+                    print(f"[{log_tag}] Inpainted mask {mask_id}: crop size {(crop_x2 - crop_x1, crop_y2 - crop_y1)}")
                 except Exception as e:
-                    print(f"[HTTP] Combined inpainting failed: {e}")
-
-            # Build mask data
-            for fm in filtered_masks:
-                binary_mask = fm["binary_mask"]
-                bbox = fm["bbox"]
-                mask_id = fm["mask_id"]
-
-                # Convert mask to binary image and resize to original image size
-                binary_mask_img = binary_mask * 255
-                mask_img_full = Image.fromarray(binary_mask_img)
-                mask_img_resized = mask_img_full.resize(image.size, Image.Resampling.NEAREST)
-
-                # Crop mask to bbox region
-                if bbox is not None:
-                    x1, y1, x2, y2 = [int(v) for v in bbox]
-                    # Clamp to image bounds
-                    x1 = max(0, x1)
-                    y1 = max(0, y1)
-                    x2 = min(image.size[0], x2)
-                    y2 = min(image.size[1], y2)
-                    mask_cropped = mask_img_resized.crop((x1, y1, x2, y2))
-                    crop_width = x2 - x1
-                    crop_height = y2 - y1
-                else:
-                    mask_cropped = mask_img_resized
-                    crop_width = image.size[0]
-                    crop_height = image.size[1]
-
-                # Compress as PNG
-                buffered = BytesIO()
-                mask_cropped.save(buffered, format="PNG", optimize=True)
-                mask_base64 = base64.b64encode(buffered.getvalue()).decode()
-
-                # Individual inpainting (only if not using combined mode)
-                inpaint_data = None
-                inpaint_bbox = None
-                if not request.combined_inpaint and bbox is not None:
-                    try:
-                        # Dilate mask for better coverage
-                        dilated_mask = binary_mask
-                        if request.dilate_pixels > 0:
-                            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (request.dilate_pixels * 2 + 1, request.dilate_pixels * 2 + 1))
-                            dilated_mask = cv2.dilate(binary_mask, kernel, iterations=1)
-
-                        # Resize mask to original image size for inpainting
-                        dilated_mask_img = Image.fromarray(dilated_mask * 255)
-                        mask_resized = dilated_mask_img.resize(image.size, Image.Resampling.NEAREST)
-
-                        # Run LaMa inpainting
-                        inpainted = lama_model(image, mask_resized)
-
-                        # Expand bbox and crop inpainted region
-                        inpaint_bbox = expand_bbox(bbox, image.size, padding_ratio=0.15)
-                        crop_x1, crop_y1, crop_x2, crop_y2 = inpaint_bbox
-                        inpaint_crop = inpainted.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-
-                        # Encode as JPEG
-                        inpaint_buffered = BytesIO()
-                        inpaint_crop.save(inpaint_buffered, format="JPEG", quality=85)
-                        inpaint_data = base64.b64encode(inpaint_buffered.getvalue()).decode()
-
-                        print(f"[HTTP] Inpainted mask {mask_id}: crop size {inpaint_crop.size}")
-                    except Exception as e:
-                        print(f"[HTTP] Inpainting failed for mask {mask_id}: {e}")
-
-                masks_data.append({
-                    "id": mask_id,
-                    "data": mask_base64,
-                    "width": crop_width,
-                    "height": crop_height,
-                    "bbox": bbox,
-                    "color": generate_distinct_color(mask_id),
-                    "inpaint_data": inpaint_data,
-                    "inpaint_bbox": inpaint_bbox,
-                })
-
-            print(f"[HTTP] Skipped {skipped_count} masks, keeping {len(masks_data)} masks")
-
-            # フィルタリング後のマスクを配列に変換
-            filtered_masks_array = np.array([fm["binary_mask"] for fm in filtered_masks]) if filtered_masks else None
-        else:
-            filtered_masks_array = None
-
-        processing_time = (datetime.now() - start_time).total_seconds()
-
-        print(f"[HTTP] Sent {len(masks_data)} masks in {processing_time:.3f}s")
+                    print(f"[{log_tag}] Inpainting failed for mask {mask_id}: {e}")
+
+            masks_data.append({
+                "id": mask_id,
+                "data": mask_cropped,
+                "width": crop_width,
+                "height": crop_height,
+                "bbox": bbox,
+                "color": COLOR_TABLE[mask_id] if mask_id < len(COLOR_TABLE) else generate_distinct_color(mask_id),
+                "inpaint_data": inpaint_data,
+                "inpaint_bbox": inpaint_bbox,
+            })
+
+        if sprite_crops and request.mask_format == "packed":
+            mask_packed, packed_offsets = await asyncio.to_thread(encode_mask_packed, sprite_crops)
+            for md, packed_offset in zip(masks_data, packed_offsets):
+                md["packed_offset"] = packed_offset
+        elif sprite_crops:
+            mask_sprite, sprite_offsets = await asyncio.to_thread(encode_mask_sprite, sprite_crops)
+            for md, sprite_y in zip(masks_data, sprite_offsets):
+                md["sprite_y"] = sprite_y
+
+        print(f"[{log_tag}] Skipped {skipped_count} masks, keeping {len(masks_data)} masks")
+
+        # フィルタリング後のマスクを配列に変換
+        filtered_masks_array = np.array([fm["binary_mask"] for fm in filtered_masks]) if filtered_masks else None
+    else:
+        filtered_masks_array = None
 
-        # 非同期でデバッグ画像を保存（レスポンス返却後）
-        timestamp = start_time.strftime("%Y%m%d_%H%M%S")
+    # 非同期でデバッグ画像を保存（バックグラウンドで実行、debug指定時のみ）
+    if request.debug:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         asyncio.create_task(save_debug_images(
             timestamp=timestamp,
             original_image=image,
@@ -518,13 +1115,53 @@ async def segment_image(request: SegmentRequest):
             segformer_predicted=segformer_predicted,
         ))
 
+    return {
+        "masks": masks_data,
+        "mask_sprite": mask_sprite,
+        "mask_packed": mask_packed,
+        "combined_inpaint": combined_inpaint_array,
+        "image_size": list(image.size),
+        "original_image_size": list(original_size),
+    }
+
+
+@app.post("/segment")
+async def segment_image(request: SegmentRequest):
+    """
+    HTTP POST エンドポイント: 画像をセグメンテーション
+    WebXRからの一回限りのリクエスト用
+    """
+    start_time = time.perf_counter()
+
+    try:
+        # Base64デコード
+        image_data = pybase64.b64decode(request.image)
+
+        async with inference_semaphore:
+            result = await run_segmentation(request, image_data, "HTTP")
+
+        # PNG/JPEG + Base64 encode on the threadpool, in parallel, so the event loop stays free for other requests
+        combined_inpaint_data, mask_sprite, mask_packed, *masks_data = await asyncio.gather(
+            asyncio.to_thread(encode_jpeg_base64, result["combined_inpaint"]),
+            asyncio.to_thread(encode_base64, result["mask_sprite"]),
+            asyncio.to_thread(encode_base64, result["mask_packed"]),
+            *(asyncio.to_thread(encode_mask_payload, md, request.mask_format) for md in result["masks"]),
+        )
+
+        processing_time = time.perf_counter() - start_time
+
+        print(f"[HTTP] Sent {len(masks_data)} masks in {processing_time:.3f}s")
+
         return {
             "success": True,
             "count": len(masks_data),
             "masks": masks_data,
             "processing_time": processing_time,
-            "image_size": list(image.size),
+            "image_size": result["image_size"],
+            "original_image_size": result["original_image_size"],
             "combined_inpaint_data": combined_inpaint_data,
+            **({"mask_sprite": mask_sprite} if request.mask_format == "sprite" else {}),
+            **({"mask_packed": mask_packed} if request.mask_format == "packed" else {}),
         }
 
     except Exception as e:
@@ -536,6 +1173,125 @@ async def segment_image(request: SegmentRequest):
         }
 
 
+# /wsのバイナリリクエストのヘッダー: conf*1000 (uint16), iou*1000 (uint16), max_masks (uint8),
+# mask_format (uint8, WS_MASK_FORMATSのインデックス), フラグ (uint8, WS_FLAG_*), max_image_size (uint16, 0なら縮小しない), 画像のバイト数 (uint32)
+WS_REQUEST_HEADER = struct.Struct("<HHBBBHI")
+WS_MASK_FORMATS = ("png", "sprite", "rle", "packed")
+WS_FLAG_COMBINED_INPAINT = 1 << 0
+WS_FLAG_EXCLUDE_BACKGROUND = 1 << 1  # exclude_background="segformer"
+
+
+def parse_ws_binary_request(data: bytes) -> tuple[SegmentRequest, memoryview]:
+    """
+    /wsのバイナリフレーム（ヘッダー + JPEG/PNG）をパース
+    ヘッダーにない項目はSegmentRequestのデフォルト値。画像はコピーせずmemoryviewで返す
+    """
+    conf, iou, max_masks, mask_format, flags, max_image_size, image_length = WS_REQUEST_HEADER.unpack_from(data)
+    if mask_format >= len(WS_MASK_FORMATS):
+        raise ValueError(f"Unknown mask_format index: {mask_format}")
+    image_data = memoryview(data)[WS_REQUEST_HEADER.size:WS_REQUEST_HEADER.size + image_length]
+    if len(image_data) != image_length:
+        raise ValueError(f"Truncated image payload: expected {image_length} bytes, got {len(image_data)}")
+    request = SegmentRequest(
+        image="",
+        conf=conf / 1000,
+        iou=iou / 1000,
+        max_masks=max_masks,
+        mask_format=WS_MASK_FORMATS[mask_format],
+        combined_inpaint=bool(flags & WS_FLAG_COMBINED_INPAINT),
+        exclude_background="segformer" if flags & WS_FLAG_EXCLUDE_BACKGROUND else "none",
+        max_image_size=max_image_size or None,
+    )
+    return request, image_data
+
+
+async def send_ws_json(websocket: WebSocket, payload: dict):
+    """JSONをorjsonでシリアライズしてテキストフレームで送る（バイナリフレームの画像と区別するためテキストのまま）"""
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """
+    WebSocket エンドポイント: 連続フレーム用
+    リクエストは/segmentと同じJSONをテキストフレームで送るか、
+    Base64なしのバイナリフレーム（WS_REQUEST_HEADER + 画像）で送る。
+    レスポンスはJSONヘッダー（テキストフレーム）の後に、画像をBase64なしのバイナリフレームで送る。
+    バイナリフレームの順番と中身はヘッダーの"frames"に並ぶ
+    （{"type": "mask_sprite" | "mask_packed" | "combined_inpaint" | "mask" | "inpaint", "id": マスクID}）
+    """
+    await websocket.accept()
+    print("[WS] Client connected")
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            start_time = time.perf_counter()
+
+            try:
+                if message.get("bytes") is not None:
+                    request, image_data = parse_ws_binary_request(message["bytes"])
+                else:
+                    request = SegmentRequest.model_validate_json(message["text"])
+                    image_data = pybase64.b64decode(request.image)
+
+                async with inference_semaphore:
+                    result = await run_segmentation(request, image_data, "WS")
+
+                # Encode PNG/JPEG payloads on the threadpool in parallel; they are sent as raw bytes
+                frames = []
+                jobs = []
+                if result["combined_inpaint"] is not None:
+                    frames.append({"type": "combined_inpaint"})
+                    jobs.append(asyncio.to_thread(encode_jpeg, result["combined_inpaint"]))
+                masks_meta = []
+                for md in result["masks"]:
+                    if md["data"] is not None:
+                        frames.append({"type": "mask", "id": md["id"]})
+                        jobs.append(asyncio.to_thread(encode_mask, md["data"], request.mask_format))
+                    if md["inpaint_data"] is not None:
+                        frames.append({"type": "inpaint", "id": md["id"]})
+                        jobs.append(asyncio.to_thread(encode_jpeg, md["inpaint_data"]))
+                    masks_meta.append({k: v for k, v in md.items() if k not in ("data", "inpaint_data")})
+                payloads = await asyncio.gather(*jobs)
+                # The sprite sheet / packed buffer is already encoded by the pipeline
+                for sheet_type in ("mask_sprite", "mask_packed"):
+                    if result[sheet_type] is not None:
+                        frames.insert(0, {"type": sheet_type})
+                        payloads.insert(0, result[sheet_type])
+
+                processing_time = time.perf_counter() - start_time
+
+                await send_ws_json(websocket, {
+                    "success": True,
+                    "count": len(masks_meta),
+                    "masks": masks_meta,
+                    "processing_time": processing_time,
+                    "image_size": result["image_size"],
+                    "original_image_size": result["original_image_size"],
+                    "frames": frames,
+                })
+                for payload in payloads:
+                    await websocket.send_bytes(payload)
+
+                print(f"[WS] Sent {len(masks_meta)} masks ({len(payloads)} binary frames) in {processing_time:.3f}s")
+
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                print(f"[WS] Error: {e}")
+                await send_ws_json(websocket, {
+                    "success": False,
+                    "error": str(e),
+                    "masks": [],
+                    "frames": [],
+                })
+
+    except WebSocketDisconnect:
+        print("[WS] Client disconnected")
+
 if __name__ == "__main__":
     import uvicorn
     import os
@@ -550,8 +1306,13 @@ if __name__ == "__main__":
     print("  Quest3からは https://localhost:8000 でアクセス")
     print("\nエンドポイント:")
     print("  POST https://localhost:8000/segment")
+    print("  WS   wss://localhost:8000/ws")
     print("="*60 + "\n")
 
+    # イベントループはloop="auto"でuvloop（インストール済みなら、Windows以外）を使う
+    # HTTPパーサーはhttptools、WebSocketはwebsockets実装（/wsに必要）
+    uvicorn_options = {"http": "httptools", "ws": "websockets"}
+
     # SSL証明書のパス (webディレクトリのmkcert証明書を使用)
     script_dir = Path(__file__).resolve().parent
     cert_dir = script_dir.parent / "web"
@@ -568,6 +1329,7 @@ if __name__ == "__main__":
             host="0.0.0.0",
             port=8000,
             log_level="info",
+            **uvicorn_options,
             ssl_keyfile=str(ssl_keyfile),
             ssl_certfile=str(ssl_certfile),
         )
@@ -582,4 +1344,5 @@ if __name__ == "__main__":
             host="0.0.0.0",
             port=8000,
             log_level="info",
+            **uvicorn_options,
         )